@@ -0,0 +1,459 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Свежие материалы сайтов из RSS/Atom и sitemap: бот зовёт run() в потоке,
+# из консоли — python site_parser.py --sites ... (см. --help)
+import io, os, re, ssl, csv, time, argparse, threading, functools, operator
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone, timedelta
+import urllib.parse as urlparse
+import urllib.request as urlrequest
+import xml.etree.ElementTree as ET
+from email.utils import parsedate_to_datetime
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import orjson
+    def json_line(obj) -> bytes: return orjson.dumps(obj) + b"\n"
+except ImportError:
+    import json
+    def json_line(obj) -> bytes: return json.dumps(obj, ensure_ascii=False).encode("utf-8") + b"\n"
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+try:
+    from lxml import html as lxml_html
+except ImportError:
+    lxml_html = None
+
+DEFAULT_UA = ("Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 "
+              "(KHTML, like Gecko) Chrome/124.0 Safari/537.36")
+HOST_BURST = 8      # столько запросов к хосту можно сделать сразу: главная + кандидаты фидов
+FEED_FETCH_WORKERS = 8
+HTTP_RETRIES = 2    # повторы на 429/5xx с экспоненциальной паузой; обрывы соединения повторяет транспорт
+RETRY_BACKOFF = 0.3
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+def root_url(url: str) -> str:
+    p = urlparse.urlparse(url)
+    scheme = p.scheme or "https"
+    return f"{scheme}://{p.netloc}/" if p.netloc else url
+
+class DeadlineExceeded(Exception):
+    pass
+
+class Fetcher:
+    # состояние одного запуска: SSL, HTTP-клиент, корзины хостов и срок.
+    # Глобалей нет — несколько запусков в одном процессе не мешают друг другу
+    def __init__(self, ssl_context, throttle: float = 0.0, deadline: Optional[float] = None):
+        self.ssl_context = ssl_context
+        self.throttle = max(0.0, throttle)  # сек на запрос к одному хосту (скорость пополнения корзины)
+        self.deadline = deadline            # time.monotonic(), после которого запрос не начинаем
+        self.client = None  # общий httpx.Client на запуск: keep-alive, TLS-рукопожатие одно на хост
+        if httpx is not None:
+            self.client = httpx.Client(
+                follow_redirects=True, headers={"User-Agent": DEFAULT_UA},
+                transport=httpx.HTTPTransport(
+                    verify=ssl_context, retries=HTTP_RETRIES,
+                    limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+                ),
+            )
+        self._buckets: Dict[str, Tuple[float, float]] = {}  # netloc -> (токены, момент)
+        self._lock = threading.Lock()
+        # один пул кандидатов фидов на весь запуск: потоков workers + FEED_FETCH_WORKERS,
+        # а не workers × FEED_FETCH_WORKERS; задачи пула новых задач не ставят — дедлока нет
+        self._feed_pool = ThreadPoolExecutor(max_workers=FEED_FETCH_WORKERS, thread_name_prefix="feeds")
+
+    def close(self):
+        self._feed_pool.shutdown(wait=False, cancel_futures=True)
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+
+    def time_left(self, timeout: float) -> float:
+        # поток не прервать снаружи — срок запуска проверяем перед каждым запросом
+        # и урезаем им таймауты, чтобы ни одно ожидание не пережило дедлайн
+        if self.deadline is None:
+            return timeout
+        left = self.deadline - time.monotonic()
+        if left <= 0:
+            raise DeadlineExceeded("site parser deadline exceeded")
+        return min(timeout, left)
+
+    def host_wait(self, url: str):
+        # token bucket на хост: вежливость к одному сайту, не тормозя остальные
+        if self.throttle <= 0: return
+        host = urlparse.urlparse(url).netloc
+        with self._lock:
+            now = time.monotonic()
+            tokens, ts = self._buckets.get(host, (HOST_BURST, now))
+            tokens = min(HOST_BURST, tokens + (now - ts) / self.throttle) - 1
+            self._buckets[host] = (tokens, now)
+        if tokens < 0:
+            time.sleep(self.time_left(-tokens * self.throttle))
+
+    def get(self, url: str, timeout: int = 25, headers: Optional[Dict[str, str]] = None) -> bytes:
+        try:
+            return self._get(url, timeout, headers)
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            # таймаут, урезанный до срока запуска, — это срок запуска, а не ошибка сайта
+            if self.deadline is not None and time.monotonic() >= self.deadline:
+                raise DeadlineExceeded("site parser deadline exceeded") from e
+            raise
+
+    def _get(self, url: str, timeout: int, headers: Optional[Dict[str, str]]) -> bytes:
+        self.host_wait(url)
+        if self.client is not None:
+            for attempt in range(HTTP_RETRIES + 1):
+                t = self.time_left(timeout)
+                resp = self.client.get(url, timeout=httpx.Timeout(t), headers=headers)
+                if resp.status_code not in RETRY_STATUSES or attempt == HTTP_RETRIES:
+                    break
+                time.sleep(self.time_left(RETRY_BACKOFF * (2 ** attempt)))
+            resp.raise_for_status()
+            return resp.content
+        req = urlrequest.Request(url, headers=headers or {"User-Agent": DEFAULT_UA})
+        with urlrequest.urlopen(req, timeout=self.time_left(timeout), context=self.ssl_context) as resp:
+            return resp.read()
+
+    def _get_or_error(self, url: str, timeout: int):
+        try:
+            return self.get(url, timeout=timeout)
+        except Exception as e:
+            return e
+
+    def get_all(self, urls: List[str], timeout: int = 25) -> List:
+        # URL одного сайта качаем разом: время = самый медленный запрос, а не сумма;
+        # на месте неудачного запроса — исключение
+        if len(urls) < 2:
+            return [self._get_or_error(u, timeout) for u in urls]
+        return list(self._feed_pool.map(lambda u: self._get_or_error(u, timeout), urls))
+
+def to_iso(dt: datetime) -> str:
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+def to_aware(dt: datetime) -> datetime:
+    return dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
+
+def _parse_iso(s: str):
+    # ISO-8601: один вызов C-парсера (Python 3.11+ понимает Z, смещения, доли секунд)
+    try:
+        return to_aware(datetime.fromisoformat(s.replace("/", "-") if "/" in s else s))
+    except Exception:
+        return None
+
+def _parse_rfc822(s: str):
+    try:
+        return to_aware(parsedate_to_datetime(s))
+    except Exception:
+        return None
+
+# одни и те же pubDate/lastmod повторяются по лентам и sitemap — кэшируем
+@functools.lru_cache(maxsize=4096)
+def parse_date_guess(s: str):
+    s = (s or "").strip()
+    if not s: return None
+    # RFC-822 («Thu, 15 Oct ...») — основной формат RSS, начинается с буквы;
+    # ISO (Atom, sitemap) — с цифры. Первым пробуем вероятный, второй — запасной
+    if s[0].isdigit():
+        return _parse_iso(s) or _parse_rfc822(s)
+    return _parse_rfc822(s) or _parse_iso(s)
+
+_ISO_DAY_RE = re.compile(r"\d{4}-\d{2}-\d{2}")
+
+def parse_date_or_default(s: Optional[str], default_dt: datetime) -> datetime:
+    if not s: return default_dt
+    s = s.strip()
+    try:
+        return to_aware(parsedate_to_datetime(s))
+    except Exception:
+        pass
+    try:
+        s2 = s.replace("/", "-").replace("T", " ").replace("Z", "")
+        if _ISO_DAY_RE.fullmatch(s2):
+            return datetime.fromisoformat(s2).replace(tzinfo=timezone.utc)
+        return to_aware(datetime.fromisoformat(s2))
+    except Exception:
+        return default_dt
+
+def ensure_dir(p): os.makedirs(p, exist_ok=True)
+
+ATOM_NS = "{http://www.w3.org/2005/Atom}"
+SITEMAP_NS = "{http://www.sitemaps.org/schemas/sitemap/0.9}"
+
+def iter_xml_elements(xml_bytes: bytes, tags):
+    # потоковый разбор: отдаём законченный элемент и сразу отцепляем его от родителя,
+    # так что в памяти живёт одна запись, а не весь DOM ленты/sitemap
+    stack = []
+    try:
+        for event, el in ET.iterparse(io.BytesIO(xml_bytes), events=("start", "end")):
+            if event == "start":
+                stack.append(el)
+                continue
+            stack.pop()
+            if el.tag in tags:
+                yield el
+                if stack: stack[-1].remove(el)
+    except ET.ParseError:
+        return
+
+def parse_feed_xml(xml_bytes: bytes):
+    ns_atom = ATOM_NS
+    for it in iter_xml_elements(xml_bytes, ("item", f"{ns_atom}entry")):
+        if it.tag == "item":
+            # RSS 2.0
+            title = (it.findtext("title") or "").strip()
+            link = (it.findtext("link") or "").strip()
+            # description ИЛИ content:encoded
+            desc = (it.findtext("description") or "").strip()
+            cenc = it.findtext("{http://purl.org/rss/1.0/modules/content/}encoded")
+            if cenc and (not desc or len(cenc) > len(desc)):
+                desc = cenc
+            pub_date = (it.findtext("pubDate") or it.findtext("date")
+                        or it.findtext("{http://purl.org/dc/elements/1.1/}date"))
+        else:
+            # Atom
+            title = (it.findtext(f"{ns_atom}title") or "").strip()
+            link_el = it.find(f"{ns_atom}link")
+            link = link_el.get("href") if link_el is not None else ""
+            pub_date = (it.findtext(f"{ns_atom}updated") or it.findtext(f"{ns_atom}published"))
+            desc = it.findtext(f"{ns_atom}summary") or ""
+            content_el = it.find(f"{ns_atom}content")
+            if content_el is not None and (not desc or len(content_el.text or "") > len(desc)):
+                desc = content_el.text or ""
+        yield title, link, pub_date, desc
+
+_LINK_TAG_RE = re.compile(r'<link[^>]+rel=["\'](?:alternate|feed)["\'][^>]+>', re.I)
+_HREF_RE = re.compile(r'href=["\']([^"\']+)["\']', re.I)
+_TYPE_RE = re.compile(r'type=["\']([^"\']+)["\']', re.I)
+_FEED_TYPE_RE = re.compile(r'(rss|atom|xml)', re.I)
+_HEAD_END_RE = re.compile(r"</head\s*>", re.I)
+_SITEMAP_LINE_RE = re.compile(r"(?im)^sitemap:\s*(\S+)$")
+_UNSAFE_NAME_RE = re.compile(r"[^A-Za-z0-9_.-]+")
+
+def _feed_links_lxml(head: str):
+    # один проход libxml2; rel может содержать несколько токенов («alternate feed»)
+    tree = lxml_html.fromstring(head)
+    for link in tree.iter("link"):
+        rel = (link.get("rel") or "").lower().split()
+        if "alternate" in rel or "feed" in rel:
+            yield link.get("href"), link.get("type")
+
+def _feed_links_regex(head: str):
+    for m in _LINK_TAG_RE.finditer(head):
+        tag = m.group(0)
+        href_m = _HREF_RE.search(tag)
+        type_m = _TYPE_RE.search(tag)
+        yield (href_m.group(1) if href_m else None), (type_m.group(1) if type_m else None)
+
+def discover_feeds(html: str, base_root: str):
+    feeds = set()
+    # <link rel="alternate" ...> живут в <head> — тело страницы не разбираем
+    m = _HEAD_END_RE.search(html)
+    head = html[:m.start()] if m else html
+    links = None
+    if lxml_html is not None and head.strip():
+        try:
+            links = list(_feed_links_lxml(head))
+        except Exception:
+            links = None
+    if links is None:
+        links = _feed_links_regex(head)
+    for href, typ in links:
+        if href:
+            if not href.startswith("http"): href = urlparse.urljoin(base_root, href)
+            if not typ or _FEED_TYPE_RE.search(typ):
+                feeds.add(href)
+    # типовые пути
+    for suffix in ["/feed", "/rss", "/rss.xml", "/atom.xml", "/feed.xml"]:
+        feeds.add(urlparse.urljoin(base_root, suffix))
+    return list(feeds)
+
+def get_sitemap_links(fetcher: Fetcher, base_root: str):
+    try:
+        rb = fetcher.get(urlparse.urljoin(base_root, "robots.txt"))
+        links = _SITEMAP_LINE_RE.findall(rb.decode("utf-8", "ignore"))
+        return links
+    except DeadlineExceeded:
+        raise
+    except Exception:
+        return []
+
+def parse_sitemap(xml_bytes: bytes):
+    for it in iter_xml_elements(xml_bytes, (f"{SITEMAP_NS}url",)):
+        loc = it.findtext(f"{SITEMAP_NS}loc", default="").strip()
+        lastmod = it.findtext(f"{SITEMAP_NS}lastmod", default="").strip()
+        yield loc, lastmod
+
+def collect_site(fetcher: Fetcher, site_url: str, end_dt, start_dt, accept_undated=True, verbose=False, max_items=2000):
+    collected, reason = [], ""
+    seen = set()  # дубли (RSS и Atom часто пересекаются) отсекаем до сборки строки
+    base_root = root_url(site_url)
+    source = base_root.rstrip("/")
+    try:
+        html = fetcher.get(base_root, timeout=25).decode("utf-8", "ignore")
+    except DeadlineExceeded:
+        raise
+    except Exception as e:
+        return [], f"get_homepage_error:{e}"
+    feeds = discover_feeds(html, base_root)
+    if verbose: print(f"[feeds] {base_root} -> {len(feeds)} candidates")
+    for f, fb in zip(feeds, fetcher.get_all(feeds)):
+        if len(collected) >= max_items: break
+        try:
+            if isinstance(fb, Exception): raise fb
+            # ленту читаем целиком: порядок записей не гарантирован (Atom сортируют
+            # по published, а фильтруем по updated) — по дате раньше времени не выходим
+            for (title, link, pub_date, desc) in parse_feed_xml(fb):
+                dt = parse_date_guess(pub_date)
+                if not dt and accept_undated:
+                    dt = end_dt
+                if not dt or not (start_dt <= dt <= end_dt):
+                    continue
+                if not link or not link.startswith("http"):
+                    link = urlparse.urljoin(base_root, link or "/")
+                link = link.strip()
+                if link in seen: continue
+                seen.add(link)
+                collected.append({
+                    "title": (title or "").strip(),
+                    "link": link,
+                    "date": to_iso(dt),
+                    "summary": (desc or "").strip(),
+                    "source": source
+                })
+                if len(collected) >= max_items: break
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            if verbose: print(f"[feed_error] {f}: {e}")
+    if not collected:
+        # sitemap бывают по десяткам МБ — качаем по одному: в памяти одно тело,
+        # и после max_items следующие не скачиваются вовсе
+        for sm in get_sitemap_links(fetcher, base_root):
+            if len(collected) >= max_items: break
+            try:
+                urls = parse_sitemap(fetcher.get(sm, timeout=25))
+                for u, lastmod in urls:
+                    dt = parse_date_guess(lastmod)
+                    if not dt and accept_undated:
+                        dt = end_dt
+                    if not dt or not (start_dt <= dt <= end_dt):
+                        continue
+                    link = (u or "").strip()
+                    if link in seen: continue
+                    seen.add(link)
+                    collected.append({
+                        "title": "",
+                        "link": link,
+                        "date": to_iso(dt),
+                        "summary": "",
+                        "source": source
+                    })
+                    if len(collected) >= max_items: break
+            except DeadlineExceeded:
+                raise
+            except Exception as e:
+                if verbose: print(f"[sitemap_error] {sm}: {e}")
+    return collected, reason
+
+CSV_FIELDS = ("date", "title", "link", "summary", "source")
+_csv_row = operator.itemgetter(*CSV_FIELDS)
+
+def write_csv(rows: List[Dict[str, str]], path: str):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    # csv.writer + кортежи через itemgetter вместо DictWriter, крупный буфер — меньше write()
+    with open(path, "w", newline="", encoding="utf-8", buffering=1 << 20) as f:
+        w = csv.writer(f)
+        w.writerow(CSV_FIELDS)
+        w.writerows(map(_csv_row, rows))
+
+def write_jsonl(rows: List[Dict[str, str]], path: str):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "wb", buffering=1 << 20) as f:
+        for r in rows: f.write(json_line(r))
+
+def run(sites: List[str], days: Optional[int], start: Optional[str], end: Optional[str],
+        throttle: float = 0.6, accept_undated=True, max_items=2000, verbose=False,
+        cafile: Optional[str] = None, insecure=False, out_dir: str = "output", workers: int = 8,
+        ssl_context: Optional[ssl.SSLContext] = None, deadline: Optional[float] = None):
+    # deadline — момент time.monotonic(), после которого запуск бросает DeadlineExceeded;
+    # CSV уже обойдённых сайтов к этому времени записаны
+    if insecure:
+        ssl_context = ssl._create_unverified_context()
+    elif ssl_context is None:
+        ssl_context = ssl.create_default_context(cafile=cafile) if cafile else ssl.create_default_context()
+    fetcher = Fetcher(ssl_context, throttle=throttle, deadline=deadline)
+
+    end_dt = parse_date_or_default(end, datetime.now(timezone.utc))
+    if days is not None and (not start and not end):
+        start_dt = end_dt - timedelta(days=days)
+    else:
+        start_dt = parse_date_or_default(start, end_dt - timedelta(days=30))
+
+    # collect_site работает с корнем сайта — один корень обходим один раз
+    sites_norm, roots = [], set()
+    for s in (sites or []):
+        s = s.strip()
+        if not s: continue
+        if not s.startswith("http"): s = "https://" + s.lstrip("/")
+        if root_url(s) in roots: continue
+        roots.add(root_url(s)); sites_norm.append(s)
+
+    def collect_one(s: str) -> List[Dict[str, str]]:
+        fetcher.time_left(0)  # срок вышел — следующий сайт не начинаем
+        rows, _ = collect_site(fetcher, s, end_dt=end_dt, start_dt=start_dt,
+                               accept_undated=accept_undated,
+                               verbose=verbose, max_items=max_items)
+        safe = _UNSAFE_NAME_RE.sub("_", urlparse.urlparse(root_url(s)).netloc or "site")
+        write_csv(rows, os.path.join(out_dir, f"{safe}.csv"))
+        return rows
+
+    # сайты независимы и упираются в сеть: обходим параллельно,
+    # throttle — per-host token bucket в Fetcher.get
+    all_rows = []
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(sites_norm)))) as pool:
+            for rows in pool.map(collect_one, sites_norm):
+                all_rows.extend(rows)
+    finally:
+        fetcher.close()
+    write_jsonl(all_rows, os.path.join(out_dir, "all_sites.jsonl"))
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Collect recent items from sites (RSS/Atom/sitemaps).")
+    p.add_argument("--sites", help="Comma-separated list of site URLs")
+    p.add_argument("--urls-file", help="Path to a text file with one site URL per line")
+    p.add_argument("--days", type=int, default=None)
+    p.add_argument("--start", help="YYYY-MM-DD (UTC)")
+    p.add_argument("--end", help="YYYY-MM-DD (UTC)")
+    p.add_argument("--throttle", type=float, default=0.6)
+    p.add_argument("--accept-undated", action="store_true")
+    p.add_argument("--max-items", type=int, default=2000)
+    p.add_argument("--workers", type=int, default=8, help="Sites fetched in parallel")
+    p.add_argument("--timeout", type=float, default=None, help="Overall run limit, seconds")
+    p.add_argument("--verbose", action="store_true")
+    p.add_argument("--cafile")
+    p.add_argument("--insecure", action="store_true")
+    p.add_argument("--out", default="output")
+    a = p.parse_args(argv)
+    sites = [s for s in (a.sites or "").split(",") if s.strip()]
+    if a.urls_file:
+        with open(a.urls_file, "r", encoding="utf-8", buffering=1 << 20) as f:
+            sites += [ln.strip() for ln in f if ln.strip() and not ln.startswith("#")]
+    try:
+        run(sites, a.days, a.start, a.end, throttle=a.throttle, accept_undated=a.accept_undated,
+            max_items=a.max_items, verbose=a.verbose, cafile=a.cafile, insecure=a.insecure, out_dir=a.out,
+            workers=a.workers, deadline=(time.monotonic() + a.timeout) if a.timeout else None)
+    except DeadlineExceeded:
+        return 124
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -3,21 +3,41 @@
 # 1) «Парсинг тг каналов» — фильтр по датам/ключам и HTML (первые 2 абзаца).
 # 2) «Парсинг сайтов» — RSS/Atom/Sitemaps, только ссылки пользователя (без пресетов), надёжный парс дат + content:encoded, HTML-вывод.
 
+import io
 import os
 import re
-import sys
+import ssl
+import time
+import types
 import csv
-import shlex
+import json
 import asyncio
+import functools
+import importlib.util
+import itertools
 import logging
+import mmap
+import operator
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
+from html import unescape
 from pathlib import Path
-from typing import List, Tuple, Optional, Set, Dict
-from html import escape as html_escape
+from typing import List, Tuple, Optional, Set, Dict, NamedTuple
 
 from dotenv import load_dotenv
-from jinja2 import Template
-from bs4 import BeautifulSoup
+from jinja2 import Environment, DictLoader
+from jinja2.environment import TemplateStream
+
+try:
+    import orjson  # быстрый JSON для обмена строками с парсером сайтов
+except ImportError:
+    orjson = None
+
+try:
+    import ahocorasick  # pyahocorasick: все ключевые слова за один проход по тексту
+except ImportError:
+    ahocorasick = None
 
 from telethon import TelegramClient
 from telethon.sessions import StringSession
@@ -27,10 +47,11 @@ from telethon.errors import (
 )
 from telethon.tl.types import Message
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Message as TgMessage, Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import TelegramError
 from telegram.ext import (
-    Application, CommandHandler, MessageHandler, ConversationHandler,
-    ContextTypes, CallbackQueryHandler, filters
+    AIORateLimiter, Application, ApplicationBuilder, CommandHandler, MessageHandler,
+    ConversationHandler, ContextTypes, CallbackQueryHandler, filters
 )
 
 # ---------- ЛОГИ ----------
@@ -43,6 +64,10 @@ log = logging.getLogger("parser-bot")
 # ---------- СОСТОЯНИЯ ----------
 (MENU, LINK, PERIOD, KEYWORDS, SITE_SITES, SITE_PERIOD, SITE_CONFIRM) = range(7)
 
+# шаблоны callback_data, компилируются один раз
+MENU_CB_RE         = re.compile(r"^menu:(tg|site)$")
+SITE_CONFIRM_CB_RE = re.compile(r"^site:(run|cancel)$")
+
 # ---------- КОНФИГ ----------
 load_dotenv()
 BOT_TOKEN       = os.getenv("BOT_TOKEN")
@@ -51,7 +76,10 @@ API_HASH        = os.getenv("API_HASH")
 SESSION_STRING  = os.getenv("TELETHON_SESSION")
 DEFAULT_DAYS    = int(os.getenv("DEFAULT_DAYS", "30"))
 RESULTS_LIMIT   = int(os.getenv("RESULTS_LIMIT", "5000"))
+REPORT_WORKERS  = int(os.getenv("REPORT_WORKERS", "4"))
+SITE_RUNS       = int(os.getenv("SITE_RUNS", "4"))  # одновременных запусков парсера сайтов
 OUTPUT_DIR      = Path(os.getenv("OUTPUT_DIR", "output"))
+PROGRESS_EDIT_INTERVAL = 2.0  # сек между правками сообщения о ходе сбора
 OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
 
 WORK_ROOT       = Path("work")  # рабочая папка для режима «сайты»
@@ -63,8 +91,27 @@ if not (BOT_TOKEN and API_ID and API_HASH and SESSION_STRING):
 # ---------- Telethon клиент ----------
 tg_client = TelegramClient(StringSession(SESSION_STRING), API_ID, API_HASH)
 
+# канал -> (когда разрешён, entity): повторный сбор того же канала без resolveUsername
+ENTITY_TTL = 3600
+ENTITY_CACHE_SIZE = 256
+_entity_cache: "OrderedDict[str, Tuple[float, object]]" = OrderedDict()
+
+async def resolve_entity(username: str):
+    key = username.lower()
+    now = time.monotonic()
+    hit = _entity_cache.get(key)
+    if hit and now - hit[0] < ENTITY_TTL:
+        _entity_cache.move_to_end(key)
+        return hit[1]
+    entity = await tg_client.get_entity(username)
+    _entity_cache[key] = (now, entity)
+    _entity_cache.move_to_end(key)
+    if len(_entity_cache) > ENTITY_CACHE_SIZE:
+        _entity_cache.popitem(last=False)
+    return entity
+
 # ---------- HTML-шаблоны ----------
-HTML_TEMPLATE_TG = Template("""
+HTML_TG_SRC = """
 <!doctype html>
 <html lang="ru">
 <head>
@@ -105,9 +152,9 @@ HTML_TEMPLATE_TG = Template("""
   </div>
 </body>
 </html>
-""".strip())
+""".strip()
 
-HTML_TEMPLATE_SITES = Template("""
+HTML_SITES_SRC = """
 <!doctype html>
 <html lang="ru">
 <head>
@@ -144,297 +191,136 @@ HTML_TEMPLATE_SITES = Template("""
   </div>
 </body>
 </html>
-""".strip())
-
-# ---------- ВСТРОЕННЫЙ ПАРСЕР САЙТОВ (исправлен) ----------
-EMBEDDED_SITE_PARSER_NAME = "embedded_site_parser.py"
-EMBEDDED_SITE_PARSER_CODE = r'''#!/usr/bin/env python3
-# -*- coding: utf-8 -*-
-import os, re, ssl, csv, time
-from datetime import datetime, timezone, timedelta
-import urllib.parse as urlparse
-import urllib.request as urlrequest
-import xml.etree.ElementTree as ET
-from email.utils import parsedate_to_datetime
-from typing import Dict, List, Optional, Tuple
-
-DEFAULT_UA = ("Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 "
-              "(KHTML, like Gecko) Chrome/124.0 Safari/537.36")
-SSL_CONTEXT = None
-
-def root_url(url: str) -> str:
-    p = urlparse.urlparse(url)
-    scheme = p.scheme or "https"
-    return f"{scheme}://{p.netloc}/" if p.netloc else url
-
-def http_get(url: str, timeout: int = 25, headers: Optional[Dict[str, str]] = None) -> bytes:
-    req = urlrequest.Request(url, headers=headers or {"User-Agent": DEFAULT_UA})
-    with urlrequest.urlopen(req, timeout=timeout, context=SSL_CONTEXT) as resp:
-        return resp.read()
-
-def to_iso(dt: datetime) -> str:
-    if dt.tzinfo is None:
-        dt = dt.replace(tzinfo=timezone.utc)
-    return dt.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
-
-def to_aware(dt: datetime) -> datetime:
-    return dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
-
-def parse_date_guess(s: str):
-    s = (s or "").strip()
-    if not s: return None
-    # RFC-2822
-    try:
-        return to_aware(parsedate_to_datetime(s))
-    except Exception:
-        pass
-    # ISO-like
-    for pat in [r"^\d{4}-\d{2}-\d{2}(?:[ T]\d{2}:\d{2}(?::\d{2})?)?Z?$",
-                r"^\d{4}/\d{2}/\d{2}$",
-                r"^\d{1,2}\s+\w+\s+\d{4}"]:
-        if re.match(pat, s):
-            try:
-                s2 = s.replace("/", "-").replace("T", " ").replace("Z", "")
-                if len(s2) == 10: s2 += " 00:00"
-                return to_aware(datetime.fromisoformat(s2))
-            except Exception:
-                pass
-    return None
-
-def parse_date_or_default(s: Optional[str], default_dt: datetime) -> datetime:
-    if not s: return default_dt
-    s = s.strip()
-    try:
-        return to_aware(parsedate_to_datetime(s))
-    except Exception:
-        pass
-    try:
-        s2 = s.replace("/", "-").replace("T", " ").replace("Z", "")
-        if re.fullmatch(r"\d{4}-\d{2}-\d{2}$", s2):
-            return datetime.fromisoformat(s2).replace(tzinfo=timezone.utc)
-        return to_aware(datetime.fromisoformat(s2))
-    except Exception:
-        return default_dt
-
-def ensure_dir(p): os.makedirs(p, exist_ok=True)
-
-def parse_feed_xml(xml_bytes: bytes):
-    try:
-        root = ET.fromstring(xml_bytes)
-    except Exception:
-        return []
-    items = []
-    # RSS 2.0
-    for it in root.findall(".//item"):
-        title = (it.findtext("title") or "").strip()
-        link = (it.findtext("link") or "").strip()
-        # description ИЛИ content:encoded
-        desc = (it.findtext("description") or "").strip()
-        cenc = it.findtext("{http://purl.org/rss/1.0/modules/content/}encoded")
-        if cenc and (not desc or len(cenc) > len(desc)):
-            desc = cenc
-        pub_date = (it.findtext("pubDate") or it.findtext("date")
-                    or it.findtext("{http://purl.org/dc/elements/1.1/}date"))
-        items.append((title, link, pub_date, desc))
-    # Atom
-    ns_atom = "{http://www.w3.org/2005/Atom}"
-    for it in root.findall(f".//{ns_atom}entry"):
-        title = (it.findtext(f"{ns_atom}title") or "").strip()
-        link_el = it.find(f"{ns_atom}link")
-        link = link_el.get("href") if link_el is not None else ""
-        pub_date = (it.findtext(f"{ns_atom}updated") or it.findtext(f"{ns_atom}published"))
-        desc = it.findtext(f"{ns_atom}summary") or ""
-        content_el = it.find(f"{ns_atom}content")
-        if content_el is not None and (not desc or len(content_el.text or "") > len(desc)):
-            desc = content_el.text or ""
-        items.append((title, link, pub_date, desc))
-    return items
-
-def discover_feeds(html: str, base_root: str):
-    feeds = set()
-    # <link rel="alternate" ...>
-    for m in re.finditer(r'<link[^>]+rel=["\'](?:alternate|feed)["\'][^>]+>', html, flags=re.I):
-        tag = m.group(0)
-        href_m = re.search(r'href=["\']([^"\']+)["\']', tag, flags=re.I)
-        type_m = re.search(r'type=["\']([^"\']+)["\']', tag, flags=re.I)
-        if href_m:
-            href = href_m.group(1)
-            if not href.startswith("http"): href = urlparse.urljoin(base_root, href)
-            if not type_m or re.search(r'(rss|atom|xml)', type_m.group(1), flags=re.I):
-                feeds.add(href)
-    # типовые пути
-    for suffix in ["/feed", "/rss", "/rss.xml", "/atom.xml", "/feed.xml"]:
-        feeds.add(urlparse.urljoin(base_root, suffix))
-    return list(feeds)
-
-def get_sitemap_links(base_root: str):
-    try:
-        rb = http_get(urlparse.urljoin(base_root, "robots.txt"))
-        links = re.findall(r"(?im)^sitemap:\s*(\S+)$", rb.decode("utf-8", "ignore"))
-        return links
-    except Exception:
-        return []
-
-def parse_sitemap(xml_bytes: bytes):
-    try:
-        root = ET.fromstring(xml_bytes)
-    except Exception:
-        return []
-    ns = {"sm": "http://www.sitemaps.org/schemas/sitemap/0.9"}
-    urls = []
-    for it in root.findall(".//sm:url", ns):
-        loc = it.findtext("sm:loc", default="", namespaces=ns).strip()
-        lastmod = it.findtext("sm:lastmod", default="", namespaces=ns).strip()
-        urls.append((loc, lastmod))
-    return urls
-
-def collect_site(site_url: str, end_dt, start_dt, throttle=0.6, accept_undated=True, verbose=False, max_items=2000):
-    collected, reason = [], ""
-    base_root = root_url(site_url)
-    try:
-        try:
-            html = http_get(base_root, timeout=25).decode("utf-8", "ignore")
-        except Exception as e:
-            return [], f"get_homepage_error:{e}"
-        feeds = discover_feeds(html, base_root)
-        if verbose: print(f"[feeds] {base_root} -> {len(feeds)} candidates")
-        for f in feeds:
-            try:
-                fb = http_get(f, timeout=25)
-                for (title, link, pub_date, desc) in parse_feed_xml(fb):
-                    dt = parse_date_guess(pub_date)
-                    if not dt and accept_undated:
-                        dt = end_dt
-                    if not dt or not (start_dt <= dt <= end_dt):
-                        continue
-                    if not link or not link.startswith("http"):
-                        link = urlparse.urljoin(base_root, link or "/")
-                    collected.append({
-                        "title": (title or "").strip(),
-                        "link": (link or "").strip(),
-                        "date": to_iso(dt),
-                        "summary": (desc or "").strip(),
-                        "source": base_root.rstrip("/")
-                    })
-            except Exception as e:
-                if verbose: print(f"[feed_error] {f}: {e}")
-        if not collected:
-            for sm in get_sitemap_links(base_root):
-                try:
-                    urls = parse_sitemap(http_get(sm, timeout=25))
-                    for u, lastmod in urls:
-                        dt = parse_date_guess(lastmod)
-                        if not dt and accept_undated:
-                            dt = end_dt
-                        if not dt or not (start_dt <= dt <= end_dt):
-                            continue
-                        collected.append({
-                            "title": "",
-                            "link": (u or "").strip(),
-                            "date": to_iso(dt),
-                            "summary": "",
-                            "source": base_root.rstrip("/")
-                        })
-                except Exception as e:
-                    if verbose: print(f"[sitemap_error] {sm}: {e}")
-        seen, deduped = set(), []
-        for it in collected:
-            lk = it["link"]
-            if lk in seen: continue
-            seen.add(lk); deduped.append(it)
-        if len(deduped) > max_items: deduped = deduped[:max_items]
-        return deduped, reason
-    finally:
-        time.sleep(throttle)
-
-def write_csv(rows: List[Dict[str, str]], path: str):
-    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
-    with open(path, "w", newline="", encoding="utf-8") as f:
-        w = csv.DictWriter(f, fieldnames=["date","title","link","summary","source"])
-        w.writeheader()
-        for r in rows: w.writerow(r)
-
-def run(sites: List[str], days: Optional[int], start: Optional[str], end: Optional[str],
-        throttle: float = 0.6, accept_undated=True, max_items=2000, verbose=False,
-        cafile: Optional[str] = None, insecure=False, out_dir: str = "output"):
-    global SSL_CONTEXT
-    if insecure:
-        SSL_CONTEXT = ssl._create_unverified_context()
-    else:
-        SSL_CONTEXT = ssl.create_default_context(cafile=cafile) if cafile else ssl.create_default_context()
-
-    end_dt = parse_date_or_default(end, datetime.now(timezone.utc))
-    if days is not None and (not start and not end):
-        start_dt = end_dt - timedelta(days=days)
-    else:
-        start_dt = parse_date_or_default(start, end_dt - timedelta(days=30))
-
-    sites_norm = []
-    for s in (sites or []):
-        s = s.strip()
-        if not s: continue
-        if not s.startswith("http"): s = "https://" + s.lstrip("/")
-        sites_norm.append(s)
-
-    all_rows = []
-    for s in sites_norm:
-        rows, _ = collect_site(s, end_dt=end_dt, start_dt=start_dt,
-                               throttle=throttle, accept_undated=accept_undated,
-                               verbose=verbose, max_items=max_items)
-        safe = re.sub(r"[^A-Za-z0-9_.-]+", "_", urlparse.urlparse(root_url(s)).netloc or "site")
-        write_csv(rows, os.path.join(out_dir, f"{safe}.csv"))
-        all_rows.extend(rows)
-    write_csv(all_rows, os.path.join(out_dir, "all_sites.csv"))
-'''
+""".strip()
+
+# одно окружение на процесс: шаблоны компилируются один раз и кэшируются,
+# autoescape экранирует заголовки/ссылки из фидов (сырой HTML — только через |safe)
+JINJA_ENV = Environment(
+    loader=DictLoader({"tg.html": HTML_TG_SRC, "sites.html": HTML_SITES_SRC}),
+    autoescape=True, trim_blocks=True, lstrip_blocks=True,
+    cache_size=-1, auto_reload=False,
+)
+HTML_TEMPLATE_TG = JINJA_ENV.get_template("tg.html")
+HTML_TEMPLATE_SITES = JINJA_ENV.get_template("sites.html")
 
 # ---------- Общие утилиты ----------
+# шаблоны компилируем один раз: вызываются на каждое сообщение/пост
+_CHAN_RE = re.compile(r"(?:t\.me/|@)([A-Za-z0-9_]{3,})/?$")
+_CHAN_NAME_RE = re.compile(r"[A-Za-z0-9_]{3,}")
+_ISO_DATE_RE = re.compile(r"\b(\d{4}-\d{2}-\d{2})\b")
+_PARA_SPLIT_RE = re.compile(r"\n\s*\n+")
+# только то, что похоже на тег/комментарий: «90 <- 95», «<3» и «x < y > z» — обычный текст
+_TAG_RE = re.compile(r"</?[A-Za-z][^>]*>|<!--.*?-->", re.S)
+_FNAME_BAD_RE = re.compile(r"[^\w\-\.\s]", re.UNICODE)
+_WS_RE = re.compile(r"\s+")
+_URL_RE = re.compile(r'https?://[^\s,]+', re.I)
+_URL_SPLIT_RE = re.compile(r"[,\s]+")
+_BARE_HOST_RE = re.compile(r"^[A-Za-z0-9\.\-]+\.[A-Za-z]{2,}$")
+
 def parse_channel_identifier(raw: str) -> str:
     raw = raw.strip()
-    m = re.search(r"(?:t\.me/|@)([A-Za-z0-9_]{3,})/?$", raw)
+    m = _CHAN_RE.search(raw)
     if m: return m.group(1)
-    if re.fullmatch(r"[A-Za-z0-9_]{3,}", raw): return raw
+    if _CHAN_NAME_RE.fullmatch(raw): return raw
     raise ValueError("Не удалось распознать ссылку/юзернейм. Пример: https://t.me/fintechfutures или @fintechfutures")
 
-def parse_period(text: str) -> Tuple[datetime, datetime]:
-    now = datetime.now(timezone.utc)
-    s = (text or "").strip().lower()
-    if re.fullmatch(r"\d{1,4}", s):
-        days = int(s); return now - timedelta(days=days), now
-    dates = re.findall(r"\b(\d{4}-\d{2}-\d{2})\b", s)
+def is_days(s: str) -> bool:
+    # «число дней» — самый частый ввод: строковый метод вместо regex (isdecimal ≡ \d)
+    return len(s) <= 4 and s.isdecimal()
+
+# разбор текста периода не зависит от «сейчас» — его и кэшируем:
+# (дней, начало, конец); «сейчас» подставляет parse_period
+@functools.lru_cache(maxsize=1024)
+def _period_spec(s: str) -> Tuple[Optional[int], Optional[datetime], Optional[datetime]]:
+    if is_days(s):
+        return int(s), None, None
+    dates = _ISO_DATE_RE.findall(s)
     if len(dates) >= 2:
         d1 = datetime.fromisoformat(dates[0]).replace(tzinfo=timezone.utc)
         d2 = datetime.fromisoformat(dates[1]).replace(tzinfo=timezone.utc)
         start, end = sorted([d1, d2])
-        return start, end + timedelta(days=1)
+        return None, start, end + timedelta(days=1)
     elif len(dates) == 1:
         d1 = datetime.fromisoformat(dates[0]).replace(tzinfo=timezone.utc)
-        return d1, now
+        return None, d1, None
     else:
-        return now - timedelta(days=DEFAULT_DAYS), now
+        return DEFAULT_DAYS, None, None
+
+def parse_period(text: str) -> Tuple[datetime, datetime]:
+    now = datetime.now(timezone.utc)
+    days, start, end = _period_spec((text or "").strip().lower())
+    if days is not None:
+        return now - timedelta(days=days), now
+    return start, end or now
+
+_KW_SPLIT = re.compile(r"[,;\n]")
 
 def normalize_keywords(text: str) -> List[str]:
-    parts = [p.strip().lower() for p in re.split(r"[,;\n]", text or "") if p.strip()]
-    seen, out = set(), []
-    for p in parts:
-        if p not in seen: seen.add(p); out.append(p)
-    return out
+    # dict.fromkeys — дедупликация с сохранением порядка за один проход
+    return list(dict.fromkeys(p.strip().lower() for p in _KW_SPLIT.split(text or "") if p.strip()))
 
 def message_text(msg: Message) -> str:
     return msg.message or ""
 
-def match_keywords(text: str, keywords: List[str]) -> bool:
-    if not keywords: return True
-    t = text.lower()
-    return any(k in t for k in keywords)
+def compile_keywords(keywords: List[str]):
+    # один матчер на все ключи: текст сканируется один раз в C, а не по разу
+    # на каждое слово; семантика подстроки сохраняется.
+    # Автомат Ахо-Корасик не зависит от числа ключей, regex — запасной вариант
+    if not keywords: return None
+    if ahocorasick is not None:
+        automaton = ahocorasick.Automaton()
+        for k in keywords:
+            automaton.add_word(k, k)
+        automaton.make_automaton()
+        return automaton
+    return re.compile("|".join(map(re.escape, keywords)))
+
+def match_keywords(text: str, matcher) -> bool:
+    if matcher is None: return True
+    if ahocorasick is not None:
+        return next(matcher.iter(text.lower()), None) is not None
+    return matcher.search(text.lower()) is not None
+
+async def edit_status(msg: TgMessage, text: str) -> None:
+    # прогресс необязателен: лимиты и «message is not modified» не должны ронять сбор
+    try:
+        await msg.edit_text(text)
+    except TelegramError:
+        pass
 
 def channel_permalink(username: Optional[str], msg_id: int) -> Optional[str]:
     return f"https://t.me/{username}/{msg_id}" if username else None
 
-def first_paragraphs_html(raw_text: str, n: int = 2) -> Optional[str]:
-    plain = BeautifulSoup(raw_text or "", "html.parser").get_text()
+# html.escape(quote=True) + "\n" -> <br> за один проход str.translate
+_PARA_ESCAPE = str.maketrans({
+    "&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;", "'": "&#x27;", "\n": "<br>",
+})
+
+def first_paragraphs_html(raw_text: str, n: int = 2,
+                          memo: Optional[Dict[str, Optional[str]]] = None) -> Optional[str]:
+    # репосты/форварды часто дублируют текст — memo (словарь одного запуска, при одном n)
+    # не даёт разбирать его повторно и уходит вместе с запуском: глобальный кэш
+    # держал бы между запросами тысячи целых статей из content:encoded
+    raw_text = raw_text or ""
+    if memo is None:
+        return _first_paragraphs_html(raw_text, n)
+    html = memo.get(raw_text, _NO_HTML)
+    if html is _NO_HTML:
+        html = memo[raw_text] = _first_paragraphs_html(raw_text, n)
+    return html
+
+_NO_HTML = object()
+
+def _first_paragraphs_html(raw_text: str, n: int) -> Optional[str]:
+    # текст из ТГ — обычно без разметки; если теги/сущности есть, хватает
+    # вырезать теги и раскодировать сущности — дерево разбора не нужно
+    if "<" not in raw_text and "&" not in raw_text:
+        plain = raw_text
+    else:
+        plain = unescape(_TAG_RE.sub("", raw_text))
     t = plain.replace("\r\n", "\n").replace("\r", "\n").strip()
     if not t: return None
-    paras = [p.strip() for p in re.split(r"\n\s*\n+", t) if p.strip()]
+    paras = [p.strip() for p in _PARA_SPLIT_RE.split(t) if p.strip()]
     if len(paras) < n:
         lines = [ln.strip() for ln in t.split("\n") if ln.strip()]
         paras = lines[:n]
@@ -442,12 +328,19 @@ def first_paragraphs_html(raw_text: str, n: int = 2) -> Optional[str]:
         paras = paras[:n]
     html_parts = []
     for p in paras:
-        p_html = html_escape(p).replace("\n", "<br>")
-        html_parts.append(f"<p>{p_html}</p>")
+        html_parts.append(f"<p>{p.translate(_PARA_ESCAPE)}</p>")
     return "".join(html_parts) if html_parts else None
 
-def render_html_tg(channel_name: str, period_str: str, chips: List[str], posts: List[dict]) -> str:
-    return HTML_TEMPLATE_TG.render(
+# пост ТГ в отчёте: кортеж вместо dict на каждое сообщение; шаблон читает p['date']
+# и т.п. как раньше — Jinja при неудаче getitem берёт атрибут
+class TgPost(NamedTuple):
+    id: int
+    date: str
+    link: Optional[str]
+    html: str
+
+def render_html_tg(channel_name: str, period_str: str, chips: List[str], posts: List[TgPost]) -> TemplateStream:
+    return HTML_TEMPLATE_TG.stream(
         title=f"{channel_name} — подборка",
         channel_name=channel_name,
         period_str=period_str,
@@ -456,8 +349,8 @@ def render_html_tg(channel_name: str, period_str: str, chips: List[str], posts:
         total=len(posts),
     )
 
-def render_html_sites(period_str: str, sources_chips: List[str], posts: List[dict]) -> str:
-    return HTML_TEMPLATE_SITES.render(
+def render_html_sites(period_str: str, sources_chips: List[str], posts: List[dict]) -> TemplateStream:
+    return HTML_TEMPLATE_SITES.stream(
         title="Сайты — подборка",
         period_str=period_str,
         chips=sources_chips,
@@ -465,9 +358,29 @@ def render_html_sites(period_str: str, sources_chips: List[str], posts: List[dic
         total=len(posts),
     )
 
+def write_html(stream: TemplateStream, fpath: Path) -> bytes:
+    # отчёт собирается целиком в памяти: эти же байты уходят в Telegram, так что
+    # потоковая запись на диск память не сэкономит. На диск — одним write, повторно не читаем
+    buf = io.BytesIO()
+    stream.dump(buf, encoding="utf-8")
+    data = buf.getvalue()
+    fpath.write_bytes(data)
+    return data
+
+_FILE_SEQ = itertools.count(1)
+_STAMP_CACHE = [0, ""]  # [секунда, отформатированная метка]: strftime — раз в секунду
+
+def file_stamp() -> str:
+    # метка времени для человека + счётчик процесса: два отчёта в одну секунду
+    # (например, «Sites__…» у двух пользователей) больше не перезаписывают друг друга
+    t = int(time.time())
+    if t != _STAMP_CACHE[0]:
+        _STAMP_CACHE[:] = [t, time.strftime("%Y%m%d_%H%M%S", time.localtime(t))]
+    return f"{_STAMP_CACHE[1]}_{next(_FILE_SEQ)}"
+
 def safe_filename(s: str) -> str:
-    s = re.sub(r"[^\w\-\.\s]", "_", s, flags=re.UNICODE).strip()
-    return re.sub(r"\s+", "_", s)
+    s = _FNAME_BAD_RE.sub("_", s).strip()
+    return _WS_RE.sub("_", s)
 
 # ---------- Утилиты «Сайты» ----------
 def user_workdir(user_id: int) -> Path:
@@ -475,37 +388,101 @@ def user_workdir(user_id: int) -> Path:
     (d / "output").mkdir(parents=True, exist_ok=True)
     return d
 
-def ensure_embedded_script_on_disk(workdir: Path) -> Path:
-    script_path = workdir / EMBEDDED_SITE_PARSER_NAME
-    script_path.write_text(EMBEDDED_SITE_PARSER_CODE, encoding="utf-8")
-    return script_path
-
-async def run_site_script(args_list: List[str], workdir: Path, timeout_sec: int = 1200) -> Tuple[int, str, str]:
-    script_path = ensure_embedded_script_on_disk(workdir)
-    cmd = [sys.executable, str(script_path)] + args_list
-    log.info("Running embedded site parser: %s", " ".join(shlex.quote(c) for c in cmd))
-    proc = await asyncio.create_subprocess_exec(
-        *cmd, cwd=str(workdir),
-        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
-    )
+# парсер сайтов — модуль site_parser.py рядом с ботом; его run() зовём в потоке,
+# без fork/exec и старта интерпретатора на каждый запуск.
+# Импорт, certifi и CA-бандл — лениво, при первом запуске, а не на старте бота
+def site_parser() -> types.ModuleType:
+    return importlib.import_module("site_parser")
+
+@functools.lru_cache(maxsize=1)
+def certifi_path() -> Optional[str]:
     try:
-        stdout_b, stderr_b = await asyncio.wait_for(proc.communicate(), timeout=timeout_sec)
-    except asyncio.TimeoutError:
-        proc.kill()
-        return 124, "", "Timeout while running embedded site parser"
-    return proc.returncode, stdout_b.decode("utf-8", errors="ignore"), stderr_b.decode("utf-8", errors="ignore")
+        import certifi
+        return certifi.where()
+    except ImportError:
+        return None
+
+# CA-бандл разбираем один раз на процесс, а не на каждый запуск парсера
+@functools.lru_cache(maxsize=1)
+def site_ssl_context() -> ssl.SSLContext:
+    return ssl.create_default_context(cafile=certifi_path())
+
+# листинг и удаление относительно открытого дескриптора каталога: ядро не разбирает
+# путь от корня на каждый файл. На Windows dir_fd нет — там обычные пути
+_DIR_FD_OK = os.unlink in os.supports_dir_fd and os.scandir in os.supports_fd
+
+def reset_site_output(workdir: Path) -> None:
+    # файлы прошлого запуска не должны попасть в новый отчёт (в т.ч. если парсер упадёт)
+    out_dir = workdir / "output"
+    if _DIR_FD_OK:
+        dfd = os.open(out_dir, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            with os.scandir(dfd) as it:
+                names = [e.name for e in it if e.is_file(follow_symlinks=False)]
+            for name in names:
+                os.unlink(name, dir_fd=dfd)
+        finally:
+            os.close(dfd)
+    else:
+        with os.scandir(out_dir) as it:
+            for e in it:
+                if e.is_file(follow_symlinks=False):
+                    os.unlink(e.path)
+    # скрипт для подпроцесса из прежних версий больше не нужен
+    (workdir / "embedded_site_parser.py").unlink(missing_ok=True)
+
+# запуски парсера живут минутами — свой пул, чтобы не занимать потоки отчётов;
+# всё состояние запуска парсер держит у себя, так что пользователи идут параллельно
+SITE_POOL = ThreadPoolExecutor(max_workers=SITE_RUNS, thread_name_prefix="site")
+_site_runs_active = 0  # меняется только из event loop
+# у пользователя одна папка work/user_<id>: второй запуск стёр бы файлы первого
+# (reset_site_output), поэтому на пользователя — не больше одного запуска сразу
+_site_run_users: Set[int] = set()
+
+def site_runs_busy() -> bool:
+    return _site_runs_active >= SITE_RUNS
+
+def _run_site_parser(parser: types.ModuleType, site_kwargs: Dict, workdir: Path, timeout_sec: int) -> None:
+    # срок считаем от фактического старта, а не от постановки в очередь пула
+    deadline = time.monotonic() + timeout_sec
+    reset_site_output(workdir)
+    # TLS trust store — общий контекст; первая загрузка тоже здесь, в потоке
+    parser.run(ssl_context=site_ssl_context(), deadline=deadline, **site_kwargs)
+
+async def run_site_script(site_kwargs: Dict, workdir: Path, timeout_sec: int = 1200) -> Tuple[int, str]:
+    # -> (код возврата, короткая ошибка); 124 — вышел срок, как у timeout(1)
+    global _site_runs_active
+    log.info("Running site parser in %s: %d sites", workdir, len(site_kwargs.get("sites") or []))
+    # поток не убить через wait_for — срок передаём парсеру, он сам прекращает обход.
+    # Импорт — здесь, до пула: если он упадёт, это обычное исключение, а не в except ниже
+    parser = site_parser()
+    _site_runs_active += 1
+    try:
+        await asyncio.get_running_loop().run_in_executor(
+            SITE_POOL, _run_site_parser, parser, site_kwargs, workdir, timeout_sec
+        )
+    except parser.DeadlineExceeded:
+        return 124, "Timeout while running site parser"
+    except Exception as e:
+        log.exception("Site parser failed")
+        return 1, f"{type(e).__name__}: {e}"
+    finally:
+        _site_runs_active -= 1
+    return 0, ""
+
+# разметка PTB неизменяема — собираем один раз и переиспользуем во всех ответах
+SITE_CONFIRM_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("▶️ Запустить", callback_data="site:run")],
+    [InlineKeyboardButton("❌ Отмена", callback_data="site:cancel")],
+])
 
 def site_confirm_keyboard() -> InlineKeyboardMarkup:
-    kb = [
-        [InlineKeyboardButton("▶️ Запустить", callback_data="site:run")],
-        [InlineKeyboardButton("❌ Отмена", callback_data="site:cancel")],
-    ]
-    return InlineKeyboardMarkup(kb)
+    return SITE_CONFIRM_KB
 
 def norm_urls_from_text(text: str) -> List[str]:
-    urls = re.findall(r'https?://[^\s,]+', text or "", flags=re.I)
-    bare = [u for u in re.split(r"[,\s]+", text or "") if u and not u.startswith("http")]
-    urls += [("https://" + b.lstrip("/")) for b in bare if re.match(r"^[A-Za-z0-9\.\-]+\.[A-Za-z]{2,}$", b)]
+    urls = _URL_RE.findall(text or "")
+    bare = [u for u in _URL_SPLIT_RE.split(text or "") if u and not u.startswith("http")]
+    urls += [("https://" + b.lstrip("/")) for b in bare if _BARE_HOST_RE.match(b)]
     out, seen = [], set()
     for u in urls:
         uu = u.strip()
@@ -513,120 +490,158 @@ def norm_urls_from_text(text: str) -> List[str]:
             seen.add(uu); out.append(uu)
     return out
 
-def build_site_args_from_context(ctx_ud: Dict) -> List[str]:
-    args: List[str] = []
-    urls: List[str] = ctx_ud.get("site_urls") or []
-    if urls:
-        args += ["--sites", ",".join(urls)]
+def urls_from_file_bytes(blob: bytes) -> List[str]:
+    # строки с # — комментарии; остальное — один вызов norm_urls_from_text:
+    # URL ищутся одним проходом regex по всему тексту, а не по строке за вызов,
+    # дубли отсекает его seen-set по ходу
+    lines = blob.decode("utf-8", errors="replace").splitlines()
+    return norm_urls_from_text("\n".join(ln for ln in lines if not ln.lstrip().startswith("#")))
+
+def build_site_kwargs_from_context(ctx_ud: Dict, workdir: Path) -> Dict:
+    kwargs: Dict = {"sites": list(ctx_ud.get("site_urls") or []),
+                    "days": None, "start": None, "end": None}
 
-    text_period: str = ctx_ud.get("site_period_text", "") or ""
-    if re.fullmatch(r"\d{1,4}", text_period.strip()):
-        args += ["--days", text_period.strip()]
+    text_period: str = (ctx_ud.get("site_period_text", "") or "").strip()
+    if is_days(text_period):
+        kwargs["days"] = int(text_period)
     else:
-        dates = re.findall(r"\b(\d{4}-\d{2}-\d{2})\b", text_period)
+        dates = _ISO_DATE_RE.findall(text_period)
         if len(dates) >= 2:
-            args += ["--start", dates[0], "--end", dates[1]]
+            kwargs["start"], kwargs["end"] = dates[0], dates[1]
         elif len(dates) == 1:
-            args += ["--start", dates[0]]
+            kwargs["start"] = dates[0]
         else:
-            args += ["--days", str(DEFAULT_DAYS)]
+            kwargs["days"] = DEFAULT_DAYS
 
     # берём элементы без даты тоже
-    args += ["--accept-undated"]
-
-    # вывод
-    args += ["--out", "output"]
-
-    # TLS trust store
+    kwargs["accept_undated"] = True
+
+    # вывод: парсер работает в процессе бота, поэтому путь абсолютный
+    kwargs["out_dir"] = str((workdir / "output").resolve())
+    return kwargs
+
+SITE_CSV_FIELDS = ("date", "title", "link", "summary", "source")
+site_row_fields = operator.itemgetter(*SITE_CSV_FIELDS)  # строка -> кортеж полей одним вызовом
+
+def _read_site_csv(path: Path, rows: List[Dict[str, str]]) -> None:
+    # csv.reader + индексы колонок: без dict на строку, как у DictReader
+    with open(path, "r", encoding="utf-8", newline="", buffering=1 << 20) as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if not header: return
+        # все поля присутствуют всегда (как в JSONL) — дальше их достаёт site_row_fields
+        cols = [header.index(k) if k in header else len(header) for k in SITE_CSV_FIELDS]
+        for row in reader:
+            n = len(row)
+            rows.append({k: (row[i] if i < n else "") for k, i in zip(SITE_CSV_FIELDS, cols)})
+
+def _read_site_jsonl(path: Path, rows: List[Dict[str, str]]) -> None:
+    # mmap: страницы файла отдаёт ОС, в куче Python живёт только текущая строка;
+    # map(loads) — без построчного цикла на Python
+    loads = orjson.loads if orjson else json.loads
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0: return  # пустой файл mmap не принимает
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            rows.extend(map(loads, (ln for ln in iter(mm.readline, b"") if not ln.isspace())))
+
+def site_output_files(out_dir: Path) -> List[Path]:
+    # all_sites.jsonl; для старых рабочих папок — all_sites.csv или CSV по сайтам.
+    # Один листинг os.scandir вместо exists() + glob: без stat и Path на каждый файл
     try:
-        import certifi
-        args += ["--cafile", certifi.where()]
-    except Exception:
-        pass
-    return args
+        with os.scandir(out_dir) as it:
+            names = {e.name for e in it if e.is_file()}
+    except FileNotFoundError:
+        return []
+    for name in ("all_sites.jsonl", "all_sites.csv"):
+        if name in names:
+            return [out_dir / name]
+    return [out_dir / n for n in sorted(names) if os.path.splitext(n)[1] == ".csv"]
 
-def read_all_sites_csv(out_dir: Path) -> List[Dict[str, str]]:
-    target = out_dir / "all_sites.csv"
+# расширение выгрузки -> читатель
+SITE_READERS = {".jsonl": _read_site_jsonl, ".csv": _read_site_csv}
+
+def read_site_files(files: List[Path]) -> List[Dict[str, str]]:
     rows: List[Dict[str, str]] = []
-    if target.exists():
-        with open(target, "r", encoding="utf-8") as f:
-            reader = csv.DictReader(f)
-            for r in reader:
-                rows.append({k: (r.get(k) or "") for k in ["date","title","link","summary","source"]})
-    else:
-        for p in out_dir.glob("*.csv"):
-            if p.name == "all_sites.csv": continue
-            with open(p, "r", encoding="utf-8") as f:
-                reader = csv.DictReader(f)
-                for r in reader:
-                    rows.append({k: (r.get(k) or "") for k in ["date","title","link","summary","source"]})
+    for p in files:
+        SITE_READERS[p.suffix](p, rows)
     return rows
 
-def site_rows_to_posts(rows: List[Dict[str, str]]) -> List[dict]:
+def read_all_sites(out_dir: Path) -> List[Dict[str, str]]:
+    return read_site_files(site_output_files(out_dir))
+
+# посты для шаблона (новые сверху) и список доменов-источников — за один проход
+def site_rows_to_posts(rows: List[Dict[str, str]]) -> Tuple[List[dict], List[str]]:
+    dt_min = datetime.min.replace(tzinfo=timezone.utc)
+
     def parse_dt(s: str) -> datetime:
         s = (s or "").strip()
         try:
             if s.endswith("Z"):
-                return datetime.fromisoformat(s.replace("Z","+00:00"))
-            return datetime.fromisoformat(s)
+                s = s[:-1] + "+00:00"
+            dt = datetime.fromisoformat(s)
+            return dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
         except Exception:
-            return datetime.min.replace(tzinfo=timezone.utc)
-
-    rows_sorted = sorted(rows, key=lambda r: parse_dt(r.get("date","")), reverse=True)
-    posts = []
-    for i, r in enumerate(rows_sorted, start=1):
-        summary_html = first_paragraphs_html(r.get("summary",""), n=2)
-        dt_disp = r.get("date","")
-        try:
-            if dt_disp:
-                dt = parse_dt(dt_disp)
-                if dt != datetime.min.replace(tzinfo=timezone.utc):
-                    dt_disp = dt.astimezone(timezone.utc).strftime("%Y-%m-%d %H:%M UTC")
-        except Exception:
-            pass
+            return dt_min
+
+    # дату каждой строки парсим один раз: и для сортировки, и для вывода
+    parsed = [(parse_dt(r["date"]), site_row_fields(r)) for r in rows]
+    parsed.sort(key=lambda t: t[0], reverse=True)
+    posts, chips, memo = [], {}, {}
+    for i, (dt, (date, title, link, summary, source)) in enumerate(parsed, start=1):
+        summary_html = first_paragraphs_html(summary, n=2, memo=memo)
+        dt_disp = date
+        if dt != dt_min:
+            dt_disp = dt.astimezone(timezone.utc).strftime("%Y-%m-%d %H:%M UTC")
+        source = source.removeprefix("https://").removeprefix("http://").strip("/")
+        if source:
+            chips[source] = None
         posts.append({
             "id": i,
             "date": dt_disp or "",
-            "link": r.get("link",""),
-            "title": r.get("title","").strip(),
-            "source": re.sub(r"^https?://", "", (r.get("source","") or "")).strip("/"),
+            "link": link,
+            "title": title.strip(),
+            "source": source,
             "html": summary_html or ""
         })
-    return posts
+    return posts, list(chips)
 
 # ---------- Главное меню ----------
+MAIN_MENU_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📰 Парсинг сайтов", callback_data="menu:site")],
+    [InlineKeyboardButton("📣 Парсинг тг каналов", callback_data="menu:tg")],
+])
+
 def main_menu_markup() -> InlineKeyboardMarkup:
-    kb = [
-        [InlineKeyboardButton("📰 Парсинг сайтов", callback_data="menu:site")],
-        [InlineKeyboardButton("📣 Парсинг тг каналов", callback_data="menu:tg")],
-    ]
-    return InlineKeyboardMarkup(kb)
+    return MAIN_MENU_KB
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Привет! Выбери режим работы:", reply_markup=main_menu_markup())
     return MENU
 
+# callback_data -> (текст ответа, следующее состояние): выбор режима — один поиск в dict
+MENU_DISPATCH = {
+    "menu:tg": (
+        "Режим: Парсинг тг каналов.\n"
+        "Скинь ссылку на канал (пример: https://t.me/fintechfutures или @fintechfutures).",
+        LINK,
+    ),
+    "menu:site": (
+        "Режим: Парсинг сайтов.\n"
+        "Пришли ссылки на сайты (через пробел/запятую), например:\n"
+        "https://finextra.com https://techcrunch.com\n\n"
+        "Можно также прислать .txt-файл (одна ссылка в строке).",
+        SITE_SITES,
+    ),
+}
+
 async def menu_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    choice = query.data
-    if choice == "menu:tg":
-        await query.edit_message_text(
-            "Режим: Парсинг тг каналов.\n"
-            "Скинь ссылку на канал (пример: https://t.me/fintechfutures или @fintechfutures)."
-        )
-        return LINK
-    elif choice == "menu:site":
-        await query.edit_message_text(
-            "Режим: Парсинг сайтов.\n"
-            "Пришли ссылки на сайты (через пробел/запятую), например:\n"
-            "https://finextra.com https://techcrunch.com\n\n"
-            "Можно также прислать .txt-файл (одна ссылка в строке)."
-        )
-        return SITE_SITES
-    else:
-        await query.edit_message_text("Неизвестный выбор. Используй /start.")
-        return ConversationHandler.END
+    text, next_state = MENU_DISPATCH.get(
+        query.data, ("Неизвестный выбор. Используй /start.", ConversationHandler.END)
+    )
+    await query.edit_message_text(text)
+    return next_state
 
 # ---------- ТГ-ветка ----------
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -659,8 +674,9 @@ async def ask_keywords(update: Update, context: ContextTypes.DEFAULT_TYPE):
     period_text = (update.message.text or "").strip()
     start_dt, end_dt = parse_period(period_text)
     context.user_data["period"] = (start_dt, end_dt)
+    context.user_data["period_str"] = period_str = period_human(start_dt, end_dt)
     await update.message.reply_text(
-        f"Ок! Период: {period_human(start_dt, end_dt)}\nТеперь пришли ключевые слова (через запятую). "
+        f"Ок! Период: {period_str}\nТеперь пришли ключевые слова (через запятую). "
         "Если оставить пустым — соберу все посты за период."
     )
     return KEYWORDS
@@ -668,49 +684,61 @@ async def ask_keywords(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def run_parse_tg(update: Update, context: ContextTypes.DEFAULT_TYPE):
     kw_raw = update.message.text or ""
     keywords = normalize_keywords(kw_raw)
+    kw_matcher = compile_keywords(keywords)
     username = context.user_data["channel_username"]
     start_dt, end_dt = context.user_data["period"]
+    period_str = context.user_data.get("period_str") or period_human(start_dt, end_dt)
 
-    await update.message.reply_text("Начинаю сбор… это может занять немного времени при больших каналах.")
+    # один статус на весь сбор: правим его по ходу, а не шлём новые сообщения
+    status = await update.message.reply_text("Начинаю сбор… это может занять немного времени при больших каналах.")
+    loop = asyncio.get_running_loop()
+    next_edit = loop.time() + PROGRESS_EDIT_INTERVAL
+    scanned = 0
     try:
-        entity = await tg_client.get_entity(username)
+        entity = await resolve_entity(username)
         chan_username = getattr(entity, "username", None)
         chan_title = getattr(entity, "title", username)
 
-        matched: List[dict] = []
-        count = 0
-
-        async for msg in tg_client.iter_messages(entity, offset_date=end_dt, reverse=False):
-            count += 1
-            if count > RESULTS_LIMIT: break
+        matched: List[TgPost] = []
+        snippet_memo: Dict[str, Optional[str]] = {}
+        start_ts, end_ts = start_dt.timestamp(), end_dt.timestamp()
+
+        # limit останавливает сам Telethon — лишние страницы getHistory не запрашиваются;
+        # wait_time=0: без пауз между страницами, FloodWait Telethon обработает сам
+        async for msg in tg_client.iter_messages(entity, offset_date=end_dt, reverse=False,
+                                                 limit=RESULTS_LIMIT, wait_time=0):
+            scanned += 1
+            if loop.time() >= next_edit:
+                next_edit = loop.time() + PROGRESS_EDIT_INTERVAL
+                await edit_status(status, f"Собираю… просмотрено: {scanned}, найдено: {len(matched)}")
             if not isinstance(msg, Message): continue
-            msg_dt = msg.date
-            if msg_dt.tzinfo is None: msg_dt = msg_dt.replace(tzinfo=timezone.utc)
-            if msg_dt >= end_dt: continue
-            if msg_dt < start_dt: break
+            msg_dt = msg.date  # Telethon отдаёт aware-время в UTC
+            msg_ts = msg_dt.timestamp()
+            if msg_ts >= end_ts: continue
+            if msg_ts < start_ts: break
 
             text = message_text(msg)
             if not text: continue
 
-            if match_keywords(text, keywords):
-                snippet_html = first_paragraphs_html(text, n=2)
+            if match_keywords(text, kw_matcher):
+                snippet_html = first_paragraphs_html(text, n=2, memo=snippet_memo)
                 if not snippet_html: continue
-                matched.append({
-                    "id": msg.id,
-                    "date": msg_dt.astimezone(timezone.utc).strftime("%Y-%m-%d %H:%M UTC"),
-                    "link": channel_permalink(chan_username, msg.id),
-                    "html": snippet_html
-                })
+                matched.append(TgPost(
+                    msg.id, msg_dt.strftime("%Y-%m-%d %H:%M UTC"),
+                    channel_permalink(chan_username, msg.id), snippet_html,
+                ))
 
-        html = render_html_tg(chan_title, period_human(start_dt, end_dt), chips=keywords, posts=matched)
-
-        ts = datetime.now().strftime("%Y%m%d_%H%M%S")
+        await edit_status(status, f"Просмотрено: {scanned}, найдено: {len(matched)}. Готовлю отчёт…")
+        ts = file_stamp()
         fname = f"{safe_filename(chan_title)}__{start_dt.date()}_{(end_dt - timedelta(days=1)).date()}__{ts}.html"
         fpath = OUTPUT_DIR / fname
-        fpath.write_text(html, encoding="utf-8")
+        # отчёт целиком в памяти (байты всё равно нужны для загрузки в Telegram), на диск — копия
+        data = await asyncio.to_thread(
+            write_html, render_html_tg(chan_title, period_str, chips=keywords, posts=matched), fpath
+        )
 
         await update.message.reply_document(
-            document=fpath.open("rb"),
+            document=data,
             filename=fname,
             caption=f"Готово! Найдено постов: {len(matched)}\n/start — вернуться в меню."
         )
@@ -729,44 +757,49 @@ async def run_parse_tg(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 # ---------- Ветка «Сайты» ----------
-async def site_collect_sites(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.message.from_user.id
-    workdir = user_workdir(user_id)
+SITE_LIST_EXT = frozenset({".txt"})  # списки сайтов, принимаемые и без text/* MIME
+# тексты ответов — шаблоны модуля, заполняются одним format
+SITES_ACCEPTED_TMPL = (
+    "Принял {n} сайт(ов):\n• {preview}{more}\n\n"
+    "Теперь укажи период (как для ТГ):\n"
+    "• число дней, например `30`\n"
+    "• или даты: `2025-08-01 2025-08-27`"
+)
+SITE_SUMMARY_TMPL = (
+    "Проверь параметры 👇\n"
+    "• Источники: {n} сайт(ов)\n"
+    "• Период: {human}\n"
+    "Запустить парсинг?"
+)
 
+async def site_collect_sites(update: Update, context: ContextTypes.DEFAULT_TYPE):
     urls: List[str] = []
     if update.message.document:
         doc = update.message.document
-        if not (doc.mime_type or "").startswith("text/") and not doc.file_name.lower().endswith(".txt"):
+        if (not (doc.mime_type or "").startswith("text/")
+                and os.path.splitext(doc.file_name or "")[1].lower() not in SITE_LIST_EXT):
             await update.message.reply_text("Это не текстовый файл. Пришли .txt или напиши ссылки текстом.")
             return SITE_SITES
-        tmp = workdir / f"sites_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
-        file = await doc.get_file()
-        await file.download_to_drive(custom_path=str(tmp))
         try:
-            with open(tmp, "r", encoding="utf-8") as f:
-                for line in f:
-                    s = line.strip()
-                    if s and not s.startswith("#"):
-                        urls.extend(norm_urls_from_text(s))
+            # список ссылок небольшой: качаем в память, без временного файла на диске;
+            # разбор большого файла — в потоке, чтобы не держать event loop
+            file = await doc.get_file()
+            blob = bytes(await file.download_as_bytearray())
+            urls = await asyncio.to_thread(urls_from_file_bytes, blob)
         except Exception as e:
             await update.message.reply_text(f"Не смог прочитать файл: {e}")
             return SITE_SITES
     else:
         urls = norm_urls_from_text(update.message.text or "")
 
-    urls = list(dict.fromkeys(urls))
     if not urls:
         await update.message.reply_text("Не нашёл ни одной ссылки. Пришли ещё раз ссылки или .txt-файл.")
         return SITE_SITES
 
     context.user_data["site_urls"] = urls
-    preview = "\n".join(f"• {u}" for u in urls[:10])
     more = "" if len(urls) <= 10 else f"\n…и ещё {len(urls)-10}"
     await update.message.reply_text(
-        f"Принял {len(urls)} сайт(ов):\n{preview}{more}\n\n"
-        "Теперь укажи период (как для ТГ):\n"
-        f"• число дней, например `30`\n"
-        f"• или даты: `2025-08-01 2025-08-27`",
+        SITES_ACCEPTED_TMPL.format(n=len(urls), preview="\n• ".join(urls[:10]), more=more),
         parse_mode="Markdown"
     )
     return SITE_PERIOD
@@ -775,28 +808,31 @@ async def site_collect_period(update: Update, context: ContextTypes.DEFAULT_TYPE
     text = (update.message.text or "").strip()
     context.user_data["site_period_text"] = text
     start_dt, end_dt = parse_period(text)
-    summary = [
-        "Проверь параметры 👇",
-        f"• Источники: {len(context.user_data.get('site_urls', []))} сайт(ов)",
-        f"• Период: {period_human(start_dt, end_dt)}",
-        "Запустить парсинг?"
-    ]
-    await update.message.reply_text("\n".join(summary),
-                                    reply_markup=InlineKeyboardMarkup([
-                                        [InlineKeyboardButton("▶️ Запустить", callback_data="site:run")],
-                                        [InlineKeyboardButton("❌ Отмена", callback_data="site:cancel")],
-                                    ]))
+    context.user_data["site_period_dt"] = (start_dt, end_dt)
+    summary = SITE_SUMMARY_TMPL.format(
+        n=len(context.user_data.get("site_urls", [])), human=period_human(start_dt, end_dt)
+    )
+    await update.message.reply_text(summary, reply_markup=site_confirm_keyboard())
     return SITE_CONFIRM
 
-def sources_from_rows(rows: List[Dict[str, str]]) -> List[str]:
-    chips = []
-    for r in rows:
-        src = (r.get("source","") or "")
-        if src:
-            src = re.sub(r"^https?://", "", src).strip("/")
-            if src and src not in chips:
-                chips.append(src)
-    return chips
+def build_sites_report(workdir: Path, start_dt: datetime, end_dt: datetime) -> Tuple[Path, bytes, int]:
+    # синхронная часть после парсинга: чтение строк, сортировка, рендер, запись
+    period_str = period_human(start_dt, end_dt)
+    rows = read_all_sites(workdir / "output")
+    posts, chips = site_rows_to_posts(rows)
+
+    ts = file_stamp()
+    fname = f"Sites__{start_dt.date()}_{(end_dt - timedelta(days=1)).date()}__{ts}.html"
+    fpath = OUTPUT_DIR / fname
+    data = write_html(render_html_sites(period_str, sources_chips=chips, posts=posts), fpath)
+    return fpath, data, len(posts)
+
+async def still_working(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # пока идёт сбор этого же разговора, ConversationHandler шлёт апдейты сюда (WAITING)
+    if update.callback_query:
+        await update.callback_query.answer("Ещё собираю прошлый отчёт…")
+    elif update.effective_message:
+        await update.effective_message.reply_text("Ещё собираю прошлый отчёт — пришлю, как будет готов.")
 
 async def site_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -809,34 +845,45 @@ async def site_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return ConversationHandler.END
 
     user_id = query.from_user.id
+    if user_id in _site_run_users:
+        await query.edit_message_text("У тебя уже идёт парсинг сайтов — дождись отчёта. /start — вернуться в меню.")
+        return ConversationHandler.END
     workdir = user_workdir(user_id)
-    args_list = build_site_args_from_context(context.user_data)
-
-    await query.edit_message_text("Запускаю парсер сайтов… Это может занять немного времени.")
+    site_kwargs = build_site_kwargs_from_context(context.user_data, workdir)
 
-    rc, out, err = await run_site_script(args_list, workdir)
-    out_dir = workdir / "output"
-    rows = read_all_sites_csv(out_dir)
-
-    start_dt, end_dt = parse_period(context.user_data.get("site_period_text",""))
-    period_str = period_human(start_dt, end_dt)
-    posts = site_rows_to_posts(rows)
-    html = render_html_sites(period_str, sources_chips=sources_from_rows(rows), posts=posts)
+    if site_runs_busy():
+        await query.edit_message_text(
+            "Сейчас парсер занят другими запросами — ты в очереди, запущу автоматически."
+        )
+    else:
+        await query.edit_message_text("Запускаю парсер сайтов… Это может занять немного времени.")
 
-    ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-    fname = f"Sites__{start_dt.date()}_{(end_dt - timedelta(days=1)).date()}__{ts}.html"
-    fpath = OUTPUT_DIR / fname
-    fpath.write_text(html, encoding="utf-8")
+    # период уже разобран в site_collect_period — не пересчитываем от другого «сейчас»
+    start_dt, end_dt = (context.user_data.get("site_period_dt")
+                        or parse_period(context.user_data.get("site_period_text","")))
+    _site_run_users.add(user_id)
+    try:
+        rc, err = await run_site_script(site_kwargs, workdir)
+        # вся синхронная работа — в пуле потоков, чтобы не держать event loop
+        fpath, data, n_posts = await asyncio.to_thread(build_sites_report, workdir, start_dt, end_dt)
+    finally:
+        _site_run_users.discard(user_id)
 
     await query.message.reply_document(
-        document=fpath.open("rb"),
-        filename=fname,
-        caption=f"Готово! Найдено материалов: {len(posts)} (rc={rc})\n/start — вернуться в меню."
+        document=data,
+        filename=fpath.name,
+        caption=(f"Готово! Найдено материалов: {n_posts} (rc={rc})\n"
+                 + (f"Парсер: {err[:200]}\n" if err else "")
+                 + "/start — вернуться в меню.")
     )
     return ConversationHandler.END
 
 # ---------- LIFECYCLE ----------
 async def on_start(app: Application):
+    # asyncio.to_thread использует executor по умолчанию — ограничиваем его явно
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=REPORT_WORKERS, thread_name_prefix="report")
+    )
     if not tg_client.is_connected():
         await tg_client.connect()
     if not await tg_client.is_user_authorized():
@@ -846,52 +893,80 @@ async def on_stop(app: Application):
     if tg_client.is_connected():
         await tg_client.disconnect()
 
-def build_application() -> Application:
+POLL_TIMEOUT = 20  # long-poll getUpdates, сек
+
+def with_rate_limiter(builder: ApplicationBuilder) -> ApplicationBuilder:
+    # общий лимит Bot API (~30 сообщений/с и лимиты на чат) держит PTB: запросы
+    # ставятся в очередь, а на RetryAfter повторяются. Нужен extra [rate-limiter]
     try:
-        import certifi
-        from telegram.request import HTTPXRequest
-        req = HTTPXRequest(http2=False, verify=certifi.where(), timeout=30.0, trust_env=True)
-        log.info("HTTPXRequest с certifi включён.")
-        return (
-            Application.builder()
-            .token(BOT_TOKEN)
-            .request(req)
-            .post_init(on_start)
-            .post_shutdown(on_stop)
-            .build()
-        )
-    except Exception as e:
-        log.warning(f"Не удалось настроить HTTPXRequest с certifi: {e}. Использую дефолтные параметры.")
-        return (
-            Application.builder()
-            .token(BOT_TOKEN)
-            .post_init(on_start)
-            .post_shutdown(on_stop)
-            .build()
-        )
+        return builder.rate_limiter(AIORateLimiter(max_retries=2))
+    except RuntimeError:
+        log.warning("aiolimiter не установлен — ограничение частоты запросов выключено.")
+        return builder
+
+def build_application() -> Application:
+    from telegram.request import HTTPXRequest
+    # HTTP/2 (нужен пакет h2): ответы, загрузки документов и getUpdates
+    # мультиплексируются поверх уже открытых TLS-соединений
+    http_version = "2" if importlib.util.find_spec("h2") else "1.1"
+    httpx_kwargs = {"trust_env": True}
+    if certifi_path():
+        httpx_kwargs["verify"] = certifi_path()
+    else:
+        log.warning("certifi не установлен — использую системное хранилище сертификатов.")
+    req = HTTPXRequest(
+        connection_pool_size=32, http_version=http_version,
+        connect_timeout=10.0, read_timeout=30.0, write_timeout=30.0, pool_timeout=3.0,
+        httpx_kwargs=httpx_kwargs,
+    )
+    # отдельный клиент для getUpdates: PTB сам прибавляет POLL_TIMEOUT к read_timeout
+    updates_req = HTTPXRequest(
+        connection_pool_size=1, http_version=http_version,
+        connect_timeout=10.0, read_timeout=5.0, pool_timeout=3.0,
+        httpx_kwargs=httpx_kwargs,
+    )
+    log.info("HTTPXRequest настроен (HTTP/%s).", http_version)
+    return with_rate_limiter(
+        Application.builder()
+        .token(BOT_TOKEN)
+        .request(req)
+        .get_updates_request(updates_req)
+        .post_init(on_start)
+        .post_shutdown(on_stop)
+    ).build()
 
 def main():
+    try:
+        import uvloop  # быстрее стандартного цикла; на Windows недоступен
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        log.info("uvloop включён.")
+    except ImportError:
+        pass
+
     application = build_application()
 
     conv = ConversationHandler(
         entry_points=[CommandHandler("start", start), CommandHandler("parse", parse_cmd)],
         states={
-            MENU: [CallbackQueryHandler(menu_choice, pattern=r"^menu:(tg|site)$")],
+            MENU: [CallbackQueryHandler(menu_choice, pattern=MENU_CB_RE)],
             # ТГ
             LINK:     [MessageHandler(filters.TEXT & ~filters.COMMAND, ask_period)],
             PERIOD:   [MessageHandler(filters.TEXT & ~filters.COMMAND, ask_keywords)],
-            KEYWORDS: [MessageHandler(filters.TEXT & ~filters.COMMAND, run_parse_tg)],
+            # сбор идёт минутами: block=False — апдейты других пользователей не ждут его
+            KEYWORDS: [MessageHandler(filters.TEXT & ~filters.COMMAND, run_parse_tg, block=False)],
             # Сайты
             SITE_SITES:  [MessageHandler((filters.Document.ALL | (filters.TEXT & ~filters.COMMAND)), site_collect_sites)],
             SITE_PERIOD: [MessageHandler(filters.TEXT & ~filters.COMMAND, site_collect_period)],
-            SITE_CONFIRM:[CallbackQueryHandler(site_confirm, pattern=r"^site:(run|cancel)$")],
+            SITE_CONFIRM:[CallbackQueryHandler(site_confirm, pattern=SITE_CONFIRM_CB_RE, block=False)],
+            ConversationHandler.WAITING: [MessageHandler(filters.ALL, still_working),
+                                          CallbackQueryHandler(still_working)],
         },
         fallbacks=[CommandHandler("cancel", cancel), CommandHandler("start", start)],
         conversation_timeout=900,
     )
 
     application.add_handler(conv)
-    application.run_polling(close_loop=False)
+    application.run_polling(close_loop=False, timeout=POLL_TIMEOUT)
 
 if __name__ == "__main__":
     main()